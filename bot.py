@@ -12,10 +12,15 @@ import feedparser
 import datetime
 import dateutil.parser
 import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from colour import Colours
+from ircmsg import max_privmsg_bytes, pack_messages, split_message
 from db import FeedDB
 from config import Config
-from feedupdater import FeedUpdater
+from feedupdater import FeedUpdater, is_quarantined
 
 
 class IRCBot(irc.bot.SingleServerIRCBot):
@@ -32,6 +37,24 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         self.color_feedname = self.__config.feedname
         self.color_url = self.__config.url
         self.dateformat = self.__config.dateformat
+        # lines get sent by one thread, so the flood delay applies to all
+        # of them and the IRC event loop never has to wait for it
+        self.__send_queue = queue.Queue()
+        sender = threading.Thread(target=self.__send_queued_lines)
+        sender.daemon = True
+        sender.start()
+        # commands are answered on their own thread, searches and other
+        # queries must not block the IRC event loop
+        self.__commands = queue.Queue()
+        worker = threading.Thread(target=self.__answer_queued_commands)
+        worker.daemon = True
+        worker.start()
+        # nick -> reply lines left for !more
+        self.__more = {}
+        self.__more_lock = threading.Lock()
+        # announcements waiting to be packed into shared lines
+        self.__pending_news = []
+        self.__pending_lock = threading.Lock()
 
         if self.__config.SSL:
             ssl_factory = irc.connection.Factory(wrapper=ssl.wrap_socket)
@@ -123,6 +146,54 @@ class IRCBot(irc.bot.SingleServerIRCBot):
                 for entry in items:
                     answer += "#" + self.__get_colored_text(self.color_num,str(entry[0])) + ": " + entry[1] + ", " + self.__get_colored_text(self.color_url,str(entry[2])) + ", " + self.__get_colored_text(self.color_date,str(entry[3])) + "\n"
 
+            # List feeds whose last fetches failed or hit the fetch limits
+            elif msg == "!health":
+                answer = ""
+                for entry in self.__db.get_degraded_feeds():
+                    if entry[4]:
+                        last_success = datetime.datetime.fromtimestamp(
+                            entry[4]
+                        ).strftime(self.dateformat)
+                    else:
+                        last_success = "never"
+                    if not entry[2]:
+                        state = "ok"
+                    elif is_quarantined(entry[2], self.__config):
+                        state = "quarantined"
+                    else:
+                        state = "failing"
+                    answer += "#" + self.__get_colored_text(self.color_num,str(entry[0])) + ": " + entry[1] + ", " + self.__get_colored_text('1',state) + ", " + str(entry[2]) + " failures in a row, " + str(entry[5]) + " over fetch limits, last success: " + self.__get_colored_text(self.color_date,last_success) + ", last error: " + str(entry[3]) + "\n"
+                if not answer:
+                    answer = "All feeds are healthy."
+
+            # Search needs FTS5, which not every sqlite has
+            elif msg.startswith("!search") and \
+                    not self.__db.search_available():
+                answer = "Search is not available, sqlite lacks FTS5 support."
+
+            # Search the titles and urls of all news for a specific feed
+            elif msg.startswith("!searchfeed"):
+                args = msg.replace("!searchfeed", "", 1).split(None, 1)
+                try:
+                    feedid = int(args[0])
+                    terms = args[1]
+                except:
+                    return self.__get_colored_text('1',"Wrong command: ") + \
+                        msg + ", use: !searchfeed <feedid> <terms>"
+                items = self.__db.search_news(
+                    terms, feedid, self.__config.feedlimit
+                )
+                answer = self.__format_news(items) or "Nothing found."
+
+            # Search the titles and urls of all news
+            elif msg.startswith("!search"):
+                terms = msg.replace("!search", "", 1).strip()
+                if not terms:
+                    return self.__get_colored_text('1',"Wrong command: ") + \
+                        msg + ", use: !search <terms>"
+                items = self.__db.search_news(terms, None, self.__config.feedlimit)
+                answer = self.__format_news(items) or "Nothing found."
+
             # Else tell the user how to use the bot
             else:
                 answer = "Use !help for possible commands."
@@ -140,11 +211,53 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         if (len(event.arguments) < 1) or (not self.__config.LISTEN_TO_PRIVMSG):
             return
 
-        # Get the message and return an answer
+        # Get the message, it gets answered by the command thread
         msg = event.arguments[0].lower().strip()
+        self.__commands.put((event.source.nick, msg))
+
+    def __answer_queued_commands(self):
+        while True:
+            nick, msg = self.__commands.get()
+            try:
+                self.__answer(nick, msg)
+            except Exception as e:
+                tb = traceback.format_exc()
+                print("command error", e, "\n", tb)
+
+    def __answer(self, nick, msg):
+        """Answers a private message command"""
+        # Continue a paginated answer
+        if msg == "!more":
+            with self.__more_lock:
+                lines = self.__more.pop(nick, None)
+            if not lines:
+                return self.send_msg(nick, "Nothing more to show.")
+            return self.__send_page(nick, lines)
 
         answer = self.__handle_msg(msg)
-        self.send_msg(event.source.nick, answer)
+        try:
+            lines = split_message(answer, self.__max_line_bytes(nick))
+        except Exception as e:
+            tb = traceback.format_exc()
+            print("send_msg error", e, "\n", tb)
+            return
+        self.__send_page(nick, lines)
+
+    def __send_page(self, nick, lines):
+        """
+        Sends the first REPLY_PAGE_LINES of a reply and keeps the rest
+        for !more.
+        """
+        page = getattr(self.__config, "REPLY_PAGE_LINES", 10)
+        rest = lines[page:]
+        lines = lines[:page]
+        with self.__more_lock:
+            if rest:
+                self.__more[nick] = rest
+                lines.append("{} more lines, send !more".format(len(rest)))
+            else:
+                self.__more.pop(nick, None)
+        self.send_lines(nick, lines)
 
     def on_pubmsg(self, connection, event):
         """ Called when a channel we're in gets a message. We use it to handle
@@ -187,19 +300,53 @@ class IRCBot(irc.bot.SingleServerIRCBot):
             )
             connection.privmsg( "NICKSERV", msg)
 
+    def __max_line_bytes(self, target):
+        return max_privmsg_bytes(self.connection.get_nickname(), target)
+
+    def send_lines(self, target, lines, sleep_s=2):
+        """
+        Queues 'lines' for 'target'. They are sent in order, waiting sleep_s
+        after each. Returns immediately.
+        """
+        if lines:
+            self.__send_queue.put((target, lines, sleep_s))
+
+    def __send_queued_lines(self):
+        while True:
+            target, lines, sleep_s = self.__send_queue.get()
+            for line in lines:
+                try:
+                    self.connection.privmsg(target, line)
+                except Exception as e:
+                    tb = traceback.format_exc()
+                    print("send_msg error", e, "\n", tb)
+                # Don't flood the target
+                time.sleep(sleep_s)
+
     def send_msg(self, target, msg, sleep_s=2):
-        """Sends the message 'msg' to 'target'"""
+        """
+        Sends the message 'msg' to 'target'. Every line of 'msg' becomes
+        one or more IRC lines, split to fit IRC's 512 byte limit.
+        """
         try:
-            msg = msg.replace('\n', ' ')
-            # only take first 510 lines, IRC has a limit of 510 chars
-            # per message including channel name, etc
-            sub_line = re.findall('.{1,510}', msg)[0]
-            self.connection.privmsg(target, sub_line)
-            # Don't flood the target
-            time.sleep(sleep_s)
+            lines = split_message(msg, self.__max_line_bytes(target))
         except Exception as e:
             tb = traceback.format_exc()
             print("send_msg error", e, "\n", tb)
+            return
+        self.send_lines(target, lines, sleep_s)
+
+    def __flush_news(self):
+        """
+        Sends the announcements collected during the packing window,
+        several to a line.
+        """
+        with self.__pending_lock:
+            msgs = self.__pending_news
+            self.__pending_news = []
+        target = self.__config.CHANNEL
+        lines = pack_messages(msgs, self.__max_line_bytes(target))
+        self.send_lines(target, lines, sleep_s=2)
 
     def rewrite_data(self, feedname, data, dtype='*'):
         """
@@ -268,11 +415,29 @@ class IRCBot(irc.bot.SingleServerIRCBot):
                 "url":   url
             }
             msg = "<{name}> {title} | {url}".format(**args)
-            self.send_msg(self.__config.CHANNEL, msg, sleep_s=2)
+            pack_s = getattr(self.__config, "PACK_ANNOUNCEMENTS_SECONDS", 0)
+            if not pack_s:
+                self.send_msg(self.__config.CHANNEL, msg, sleep_s=2)
+                return
+            # collect the burst and send it when the window closes
+            with self.__pending_lock:
+                self.__pending_news.append(msg)
+                first = len(self.__pending_news) == 1
+            if first:
+                timer = threading.Timer(pack_s, self.__flush_news)
+                timer.daemon = True
+                timer.start()
         except Exception as e:
             tb = traceback.format_exc()
             print("post news error", e, "\n", tb)
 
+    def __format_news(self, items):
+        """Formats (id, title, url, date) news rows, one per line"""
+        answer = ""
+        for entry in items:
+            answer += "#" + self.__get_colored_text(self.color_num,str(entry[0])) + ": " + entry[1] + ", " + self.__get_colored_text(self.color_url,str(entry[2])) + ", " + self.__get_colored_text(self.color_date,str(entry[3])) + "\n"
+        return answer
+
     def __get_colored_text(self, color, text):
         if not self.__config.use_colors:
             return text
@@ -287,10 +452,14 @@ class IRCBot(irc.bot.SingleServerIRCBot):
 Help:
     Send all commands as a private message to {}
     - !help         Prints this help
+    - !more         Continues a long answer
     - !list         Prints all feeds
     - !stats        Prints some statistics
     - !last         Prints the last 10 entries
     - !lastfeed <feedid> Prints the last 10 entries from a specific feed
+    - !health       Prints feeds that fail to update
+    - !search <terms> Searches all entries for the given terms
+    - !searchfeed <feedid> <terms> Searches the entries of a specific feed
 """.format(self.connection.get_nickname())
 
 class Bot(object):
@@ -303,6 +472,9 @@ class Bot(object):
         self.__irc = IRCBot(self.__config, self.__db, self.on_started)
         self.__feedupdater = FeedUpdater(self.__config, self.__db)
         self.__connected = False
+        self.__start_time = None
+        # set once the initial crawl has marked existing news as seen
+        self.__warmed_up = threading.Event()
 
     def __check_config(self):
         necessary_options = [
@@ -320,20 +492,79 @@ class Bot(object):
     def get_missing_options(self):
         return self.__missing_options
 
+    def get_config(self):
+        return self.__config
+
     def start(self):
         """Starts the IRC bot"""
+        self.__start_time = time.time()
         threading.Thread(target=self.__irc.start).start()
 
     def initial_feed_update(self):
+        """
+        Crawls all feeds once in the background, marking their news as seen
+        without announcing them. Feed updates for the channel only start
+        after this is done. Returns immediately.
+        """
+        # in sharded mode the updater processes do the fetching
+        if not self.__config.update_before_connecting or self.__sharded():
+            self.__warmed_up.set()
+            return
+
+        t = threading.Thread(target=self.__warm_up)
+        t.daemon = True
+        t.start()
+
+    def __warm_up(self):
         def print_feed_update(feed_title, news_title, news_url, news_date):
             print(("[+]: {}||{}||{}||{}".format(
                 feed_title, news_title, news_url, news_date
             )))
 
-        if self.__config.update_before_connecting:
-            print("Started pre-connection updates!")
-            self.__feedupdater.update_feeds(print_feed_update, False)
-            print("DONE!")
+        def print_progress(done, total):
+            print("Initial updates: {}/{} feeds done".format(done, total))
+
+        started = time.time()
+        print("Started initial updates!")
+        try:
+            # store everything, the chat table gets reset on join and
+            # must not keep the crawl from marking news as seen
+            self.__feedupdater.update_feeds(
+                print_feed_update, False, print_progress, seen_only=True
+            )
+        except Exception as e:
+            tb = traceback.format_exc()
+            print("initial update error", e, "\n", tb)
+        print("Initial updates DONE in {:.1f}s!".format(time.time() - started))
+        self.__warmed_up.set()
+
+    def __start_feed_updates(self):
+        if not self.__warmed_up.is_set():
+            print("Waiting for initial updates before announcing news")
+            self.__warmed_up.wait()
+        self.__feedupdater.update_feeds(self.__irc.post_news, True)
+        print("Started feed updates!")
+
+    def __sharded(self):
+        return getattr(self.__config, "SHARDED", False)
+
+    def __announce_queued_news(self):
+        """
+        Posts the news queued by the shard worker processes. We own the IRC
+        connection, so every announcement goes through here.
+        """
+        poll_s = getattr(self.__config, "ANNOUNCE_POLL_SECONDS", 5)
+        while True:
+            try:
+                items = self.__db.pop_queued_news()
+                for feed_name, title, url, date in items:
+                    self.__irc.post_news(feed_name, title, url, date)
+            except Exception as e:
+                tb = traceback.format_exc()
+                print("announce error", e, "\n", tb)
+                items = []
+            if not items:
+                time.sleep(poll_s)
 
     def on_started(self):
         """
@@ -341,9 +572,21 @@ class Bot(object):
         connection.
         """
         if not self.__connected:
-            print("Connected!")
-            self.__feedupdater.update_feeds(self.__irc.post_news, True)
-            print("Started feed updates!")
+            if self.__start_time is not None:
+                print("Connected in {:.2f}s!".format(
+                    time.time() - self.__start_time
+                ))
+            else:
+                print("Connected!")
+            if self.__sharded():
+                t = threading.Thread(target=self.__announce_queued_news)
+                t.daemon = True
+                t.start()
+                print("Started announcing news from shard workers!")
+            else:
+                t = threading.Thread(target=self.__start_feed_updates)
+                t.daemon = True
+                t.start()
             if self.__config.WAIT_FOR_FIRST_MSG:
                 print("Clearing last messages table")
                 self.__db.reset_messages_count()
@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 import os
+import re
 import datetime
+import sqlite3
+import threading
 import time
 
 import logging
@@ -10,11 +13,35 @@ logging.basicConfig(level=logging.ERROR)
 
 from sqlite3worker import Sqlite3Worker
 
+# url parts everybody has, not worth indexing for search
+URL_STOPWORDS = set([
+    'http', 'https', 'www', 'com', 'org', 'net', 'html', 'htm', 'php',
+    'asp', 'aspx', 'index',
+])
+# rows indexed per transaction when indexing existing news
+INDEX_BATCH_SIZE = 500
+
+
+def url_keywords(url):
+    """
+    Returns the searchable words of a url, e.g. 'krebsonsecurity 2016 ddos'
+    for 'https://krebsonsecurity.com/2016/ddos/'.
+    """
+    words = re.split(r'\W+', url or '')
+    return " ".join(
+        word for word in words
+        if word and word.lower() not in URL_STOPWORDS
+    )
+
+
 class FeedDB(object):
     def __init__(self, config):
-        self.__db_path = "./feeds.db"
+        self.__db_path = getattr(config, "DB_PATH", "./feeds.db")
         self.__db_worker = None
         self.__config = config
+        self.__search_available = False
+        # per thread read-only connections for searches
+        self.__readers = threading.local()
         self.__initiate_db()
 
     def __initiate_db(self):
@@ -24,6 +51,8 @@ class FeedDB(object):
         """
         # If the database doesn't exist, create and prepopulate it with feeds.sql
         self.__db_worker = Sqlite3Worker(self.__db_path)
+        # WAL lets searches read while the worker writes
+        self.__db_worker.execute('PRAGMA journal_mode=WAL')
         self.__db_worker.execute(
             'CREATE TABLE feeds (id INTEGER PRIMARY KEY AUTOINCREMENT, ' \
             'name CHAR(200) UNIQUE, url CHAR(200) UNIQUE, ' \
@@ -32,19 +61,130 @@ class FeedDB(object):
         self.__db_worker.execute(
             'CREATE TABLE news (id INTEGER PRIMARY KEY AUTOINCREMENT, ' \
             'title CHAR(255), url CHAR(255), feedid INTEGER, ' \
-            'published TEXT, version INTEGER, ' \
+            'published TEXT, version INTEGER, urlwords TEXT, ' \
 			'FOREIGN KEY(feedid) REFERENCES feeds(id))'
         )
+        # searchable words of the url, for databases from before search
+        self.__db_worker.execute('ALTER TABLE news ADD COLUMN urlwords TEXT')
         self.__db_worker.execute(
             'CREATE TABLE chat (id INTEGER PRIMARY KEY AUTOINCREMENT, ' \
             'chan CHAR(255), time REAL)'
         )
+        # Feed leases for sharded updater processes. A worker owns a feed
+        # until its lease expires, so feeds of dead workers get reclaimed.
+        self.__db_worker.execute(
+            'CREATE TABLE leases (feedid INTEGER PRIMARY KEY, ' \
+            'owner CHAR(64), expires REAL, ' \
+            'FOREIGN KEY(feedid) REFERENCES feeds(id))'
+        )
+        self.__db_worker.execute(
+            'CREATE TABLE workers (owner CHAR(64) PRIMARY KEY, expires REAL)'
+        )
+        # New items found by sharded workers, waiting for the announcer
+        self.__db_worker.execute(
+            'CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, ' \
+            'feedname CHAR(200), title CHAR(255), url CHAR(255), ' \
+            'published TEXT)'
+        )
+        self.__db_worker.execute(
+            'CREATE TABLE health (feedid INTEGER PRIMARY KEY, ' \
+            'failures INTEGER, last_error TEXT, last_failure REAL, ' \
+            'last_success REAL, limit_hits INTEGER DEFAULT 0, ' \
+            'FOREIGN KEY(feedid) REFERENCES feeds(id))'
+        )
+        self.__initiate_search_index()
         if os.path.exists("./feeds.sql"):
             f = open("./feeds.sql", "r")
             for insert in f.readlines():
                 self.__db_worker.execute(insert.strip())
             f.close()
 
+    def __initiate_search_index(self):
+        """
+        Create the full-text index over news titles and url keywords. A
+        trigger keeps it up to date on every insert_news, existing news gets
+        indexed in the background. Search stays disabled if this sqlite
+        lacks FTS5.
+        """
+        self.__db_worker.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS news_fts USING fts5(" \
+            "title, urlwords, content='news', content_rowid='id')"
+        )
+        # without the index the trigger would make every insert fail
+        if not self.__fts_exists():
+            print("sqlite has no FTS5 support, search is disabled")
+            return
+        self.__search_available = True
+        self.__db_worker.execute(
+            "CREATE TRIGGER IF NOT EXISTS news_fts_insert AFTER INSERT ON " \
+            "news BEGIN INSERT INTO news_fts (rowid, title, urlwords) " \
+            "VALUES (new.id, new.title, new.urlwords); END"
+        )
+        t = threading.Thread(target=self.__index_existing_news)
+        t.daemon = True
+        t.start()
+
+    def __index_existing_news(self):
+        """
+        Indexes news stored before the search index existed, recognizable
+        by their missing url keywords. Runs on its own connection in small
+        batches so it doesn't hold up the worker's writes.
+        """
+        conn = sqlite3.connect(self.__db_path)
+        try:
+            indexed = 0
+            while True:
+                rows = conn.execute(
+                    "select id, title, url from news where urlwords is null " \
+                    "limit ?", (INDEX_BATCH_SIZE,)
+                ).fetchall()
+                if not rows:
+                    break
+                rows = [
+                    (news_id, title, url_keywords(url))
+                    for news_id, title, url in rows
+                ]
+                conn.executemany(
+                    "update news set urlwords = ? where id = ?",
+                    [(words, news_id) for news_id, title, words in rows]
+                )
+                conn.executemany(
+                    "insert into news_fts (rowid, title, urlwords) " \
+                    "values (?, ?, ?)", rows
+                )
+                conn.commit()
+                indexed += len(rows)
+            if indexed:
+                print("Indexed", indexed, "news for search")
+        except Exception as e:
+            print("Error indexing news for search", e)
+        finally:
+            conn.close()
+
+    def __reader(self):
+        """Returns this thread's read-only connection"""
+        conn = getattr(self.__readers, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.__db_path)
+            conn.execute("PRAGMA query_only = 1")
+            self.__readers.conn = conn
+        return conn
+
+    def __fts_exists(self):
+        return self.__db_worker.execute(
+            "select count(*) from sqlite_master where name = 'news_fts'"
+        )[0][0] > 0
+
+    def search_available(self):
+        """Returns True if this sqlite supports the search index"""
+        return self.__search_available
+
+    def close(self):
+        """
+        Writes out all queued queries and closes the database.
+        """
+        self.__db_worker.close()
+
     def get_feeds(self):
         """Returns all feeds"""
         feeds = []
@@ -84,6 +224,36 @@ class FeedDB(object):
             news.append(item)
         return news
 
+    def search_news(self, terms, feed_id=None, limit=10):
+        """
+        Returns up to 'limit' news whose title or url contain all of
+        'terms', best matches first. Optionally only from one feed.
+        Searches run on their own connection, not the worker's, so call
+        this from a thread that may block, not the IRC event loop.
+        """
+        # quote every term so user input can't use FTS query syntax
+        query = " ".join(
+            '"{}"'.format(term.replace('"', '""')) for term in terms.split()
+        )
+        if not query:
+            return []
+        params = {'query': query, 'limit': limit}
+        sql = "select news.id, news.title, news.url, news.published " \
+            "from news_fts join news on news.id = news_fts.rowid " \
+            "where news_fts match :query "
+        if feed_id is not None:
+            params['feedid'] = feed_id
+            sql += "and news.feedid = :feedid "
+        sql += "order by news_fts.rank limit :limit"
+        return self.__reader().execute(sql, params).fetchall()
+
+    def feed_has_news(self, feed_id):
+        """Returns True if any news of the feed has been stored"""
+        return bool(self.__db_worker.execute(
+            "select exists(select 1 from news where feedid = :feedid)",
+            {"feedid": feed_id}
+        )[0][0])
+
     def get_feeds_count(self):
         """Returns the feed count"""
         return self.__db_worker.execute("select count(id) from feeds")[0][0]
@@ -115,14 +285,69 @@ class FeedDB(object):
             return False
         params = {
             'title': title, 'url': url,
-            'feedid': feed_id, 'published': published
+            'feedid': feed_id, 'published': published,
+            'urlwords': url_keywords(url)
         }
         self.__db_worker.execute(
-            "INSERT INTO news (title, url, feedid, published) VALUES " \
-            "(:title, :url, :feedid, :published)", params
+            "INSERT INTO news (title, url, feedid, published, urlwords) " \
+            "VALUES (:title, :url, :feedid, :published, :urlwords)", params
         )
         return True
 
+    def record_feed_success(self, feed_id):
+        """
+        Reset a feed's failure count after it has been fetched successfully.
+        """
+        self.__db_worker.execute(
+            "insert or ignore into health (feedid, failures) " \
+            "values (:feedid, 0)", {"feedid": feed_id}
+        )
+        self.__db_worker.execute(
+            "update health set failures = 0, last_success = :now " \
+            "where feedid = :feedid",
+            {"feedid": feed_id, "now": self.now_timestamp()}
+        )
+
+    def record_feed_failure(self, feed_id, error, limit_hit=False):
+        """
+        Count a failed fetch of a feed, 'limit_hit' if it was aborted for
+        exceeding the fetch limits. Returns its consecutive failures.
+        """
+        self.__db_worker.execute(
+            "insert or ignore into health (feedid, failures) " \
+            "values (:feedid, 0)", {"feedid": feed_id}
+        )
+        self.__db_worker.execute(
+            "update health set failures = failures + 1, " \
+            "limit_hits = limit_hits + :limit_hit, " \
+            "last_error = :error, last_failure = :now where feedid = :feedid",
+            {"feedid": feed_id, "error": error, "now": self.now_timestamp(),
+             "limit_hit": int(limit_hit)}
+        )
+        return self.__db_worker.execute(
+            "select failures from health where feedid = :feedid",
+            {"feedid": feed_id}
+        )[0][0]
+
+    def get_degraded_feeds(self):
+        """
+        Returns (id, name, failures, last_error, last_success, limit_hits)
+        of all feeds whose last fetch failed or that ever exceeded the fetch
+        limits, most failures first.
+        """
+        feeds = []
+        queryresult = self.__db_worker.execute(
+            "select feeds.id, feeds.name, health.failures, " \
+            "health.last_error, health.last_success, health.limit_hits " \
+            "from health " \
+            "join feeds on feeds.id = health.feedid " \
+            "where health.failures > 0 or health.limit_hits > 0 " \
+            "order by health.failures desc, health.limit_hits desc"
+        )
+        for feed in queryresult:
+            feeds.append(feed)
+        return feeds
+
     def set_new_chan_message(self, chan):
         """
         Keep track of time of last message for a given channel. This enables
@@ -196,3 +421,109 @@ class FeedDB(object):
         if results:
             return False
         return True
+
+    def claim_feeds(self, owner, lease_seconds):
+        """
+        Renew the leases held by 'owner' and claim free or expired feeds up
+        to a fair share (feeds / live workers). Returns the feeds owned by
+        'owner' after claiming, in the same format as get_feeds.
+        """
+        now = self.now_timestamp()
+        expires = now + lease_seconds
+        # make sure every feed has a lease row we can claim
+        self.__db_worker.execute(
+            "insert or ignore into leases (feedid, owner, expires) " \
+            "select id, '', 0 from feeds"
+        )
+        # announce ourselves, so the others make room for us
+        self.__db_worker.execute(
+            "insert or replace into workers (owner, expires) " \
+            "values (:owner, :expires)",
+            {"owner": owner, "expires": expires}
+        )
+        self.__db_worker.execute(
+            "update leases set expires = :expires where owner = :owner",
+            {"owner": owner, "expires": expires}
+        )
+        feeds_count = self.get_feeds_count()
+        workers = self.__db_worker.execute(
+            "select count(owner) from workers where expires > :now",
+            {"now": now}
+        )[0][0]
+        held = self.__db_worker.execute(
+            "select count(feedid) from leases where owner = :owner",
+            {"owner": owner}
+        )[0][0]
+        share = -(-feeds_count // workers)
+        if held < share:
+            # a single update statement is atomic, so two workers can never
+            # claim the same feed
+            self.__db_worker.execute(
+                "update leases set owner = :owner, expires = :expires " \
+                "where feedid in (select feedid from leases where " \
+                "expires <= :now order by feedid limit :limit)",
+                {"owner": owner, "expires": expires, "now": now,
+                 "limit": share - held}
+            )
+        elif held > share:
+            # give feeds back so newly started workers get their share
+            self.__db_worker.execute(
+                "update leases set owner = '', expires = 0 " \
+                "where feedid in (select feedid from leases where " \
+                "owner = :owner order by feedid desc limit :limit)",
+                {"owner": owner, "limit": held - share}
+            )
+        return self.get_owned_feeds(owner)
+
+    def get_owned_feeds(self, owner):
+        """Returns all feeds leased by 'owner'"""
+        feeds = []
+        queryresult = self.__db_worker.execute(
+            "select feeds.id, feeds.name, feeds.url, feeds.frequency " \
+            "from feeds join leases on leases.feedid = feeds.id " \
+            "where leases.owner = :owner", {"owner": owner}
+        )
+        for feed in queryresult:
+            feeds.append(feed)
+        return feeds
+
+    def release_feeds(self, owner):
+        """
+        Give up all leases held by 'owner' and sign off, so other workers
+        can claim the feeds right away.
+        """
+        self.__db_worker.execute(
+            "update leases set owner = '', expires = 0 where owner = :owner",
+            {"owner": owner}
+        )
+        self.__db_worker.execute(
+            "delete from workers where owner = :owner", {"owner": owner}
+        )
+
+    def queue_news(self, feed_name, title, url, published):
+        """
+        Queue a new news item for the announcer process.
+        """
+        params = {
+            'feedname': feed_name, 'title': title,
+            'url': url, 'published': published
+        }
+        return self.__db_worker.execute(
+            "INSERT INTO outbox (feedname, title, url, published) VALUES " \
+            "(:feedname, :title, :url, :published)", params
+        )
+
+    def pop_queued_news(self, limit=10):
+        """
+        Returns up to 'limit' queued news items, oldest first, and removes
+        them from the queue.
+        """
+        items = self.__db_worker.execute(
+            "select id, feedname, title, url, published from outbox " \
+            "order by id limit :limit", {"limit": limit}
+        )
+        if items:
+            self.__db_worker.execute(
+                "delete from outbox where id <= :id", {"id": items[-1][0]}
+            )
+        return [item[1:] for item in items]
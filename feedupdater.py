@@ -7,13 +7,51 @@ import dateutil.parser
 import signal
 import time
 import requests
+from requests.packages.urllib3.exceptions import ReadTimeoutError
 import threading
 import os
+import sys
 import traceback
 import random
 import re
+import socket
 from db import FeedDB
 from config import Config
+from websub import WebSubSubscriber, find_hub
+from profiler import StageTimer, install as install_profiler
+
+# failing feeds are polled less and less often, up to this many minutes
+DEFAULT_MAX_BACKOFF_MINUTES = 180
+# after this many failures in a row a feed is quarantined and only probed
+# every DEFAULT_PROBE_MINUTES
+DEFAULT_QUARANTINE_FAILURES = 10
+DEFAULT_PROBE_MINUTES = 360
+
+# limits for fetching a single feed, override them per feed name with
+# FETCH_LIMITS in the config
+DEFAULT_FETCH_LIMITS = {
+    # seconds to wait for the connection and for each read from the socket
+    'connect_timeout': 10,
+    'read_timeout': 30,
+    # seconds the whole download may take
+    'max_seconds': 120,
+    # bytes of (decompressed) body we accept
+    'max_bytes': 5 * 1024 * 1024,
+}
+FETCH_CHUNK_BYTES = 16 * 1024
+
+
+class FetchLimitError(IOError):
+    """Raised when a feed download exceeds its fetch limits"""
+
+
+def is_quarantined(failures, config):
+    """
+    Returns True if a feed failing 'failures' times in a row is quarantined.
+    """
+    return failures >= getattr(
+        config, "FEED_QUARANTINE_FAILURES", DEFAULT_QUARANTINE_FAILURES
+    )
 
 
 def shorten_url(url, config):
@@ -52,8 +90,34 @@ class FeedUpdater(object):
         self.__config = config
         self.__db = db
         self.__threads = []
+        # ids of feeds leased by this process, None when not sharded
+        self.__owned = None
+        self.__feed_locks = {}
+        self.__feed_locks_lock = threading.Lock()
+        # feed id -> (feed_info, callback) for content pushed via WebSub
+        self.__push_targets = {}
+        # feed id -> pushed content waiting for the channel to become idle
+        self.__deferred_pushes = {}
+        self.__deferred_lock = threading.Lock()
+        self.__websub = None
+        if getattr(self.__config, "WEBSUB_CALLBACK_URL", None):
+            self.__websub = WebSubSubscriber(self.__config, self.__on_push)
 
-    def update_feeds(self, callback=None, forever=False):
+    def update_feeds(self, callback=None, forever=False, progress=None,
+                     seen_only=False):
+        """
+        Starts a thread per feed. Unless 'forever' is set, waits for all of
+        them to finish, calling progress(done, total) along the way. With
+        'seen_only' all news is stored regardless of channel activity, for
+        marking it as seen without announcing it.
+        """
+        if forever and self.__websub is not None:
+            try:
+                self.__websub.start()
+            except Exception as e:
+                # push is optional, keep polling everything without it
+                print("WebSub disabled, can't start callback server:", e)
+                self.__websub = None
         for feed in self.__db.get_feeds():
             t = threading.Thread(
                 target=self.__fetch_feed,
@@ -62,15 +126,240 @@ class FeedUpdater(object):
                     'title': feed[1],
                     'url': feed[2],
                     'published': feed[3]
-                }, callback, forever,
+                }, callback, forever, seen_only,
             ))
             t.start()
             self.__threads.append(t)
 
         if not forever:
-            for thread in self.__threads:
+            threads = list(self.__threads)
+            for done, thread in enumerate(threads, 1):
                 thread.join()
                 self.__threads.remove(thread)
+                if progress is not None:
+                    progress(done, len(threads))
+
+    def run_shard(self, worker_id=None):
+        """
+        Run as one of several updater processes sharing the feeds table.
+        Feeds are leased from the database and new items are queued for
+        the announcer process instead of being posted directly. Never
+        returns.
+        """
+        if worker_id is None:
+            worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+        lease_seconds = getattr(self.__config, "SHARD_LEASE_SECONDS", 120)
+        self.__owned = set()
+        threads = {}
+        print("Shard worker", worker_id, "started")
+        try:
+            while True:
+                feeds = self.__db.claim_feeds(worker_id, lease_seconds)
+                self.__owned = set(feed[0] for feed in feeds)
+                for feed in feeds:
+                    if feed[0] in threads and threads[feed[0]].is_alive():
+                        continue
+                    print("Shard worker", worker_id, "claimed", feed[2])
+                    # there is no warm-up crawl in sharded mode, mark the
+                    # backlog of feeds we never fetched before as seen
+                    seen_only = self.__config.update_before_connecting and \
+                        not self.__db.feed_has_news(feed[0])
+                    t = threading.Thread(
+                        target=self.__fetch_feed,
+                        args=({
+                            'id': feed[0],
+                            'title': feed[1],
+                            'url': feed[2],
+                            'published': feed[3]
+                        }, self.__db.queue_news, True, seen_only,
+                    ))
+                    t.daemon = True
+                    t.start()
+                    threads[feed[0]] = t
+                # renew well before the lease runs out
+                time.sleep(lease_seconds / 3.0)
+        finally:
+            self.__db.release_feeds(worker_id)
+            # writes are queued, make sure the release reaches the database
+            self.__db.close()
+
+    def fetch_limits(self, feed_name):
+        """
+        Returns the fetch limits for a feed, the defaults updated with the
+        feed's entry in the config's FETCH_LIMITS.
+        """
+        limits = dict(DEFAULT_FETCH_LIMITS)
+        limits.update(getattr(self.__config, "FETCH_LIMITS", {}).get(
+            feed_name, {}
+        ))
+        return limits
+
+    def fetch_feed(self, feed_info, timer=None):
+        """
+        Downloads and parses a feed. The body is streamed in chunks and the
+        download is aborted with a FetchLimitError as soon as it exceeds the
+        feed's size or time limits.
+        """
+        timer = timer or StageTimer()
+        limits = self.fetch_limits(feed_info['title'])
+        started = time.time()
+        try:
+            with timer.stage('connect'):
+                response = requests.get(
+                    feed_info['url'],
+                    stream=True,
+                    timeout=(
+                        limits['connect_timeout'], limits['read_timeout']
+                    ),
+                    headers={'User-Agent': feedparser.USER_AGENT}
+                )
+        except requests.exceptions.Timeout as e:
+            raise FetchLimitError("Fetch timed out: {}".format(e))
+
+        # close the response once the deadline passes, so a server sending
+        # a trickle of bytes can't keep us waiting for a full chunk
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            # closing alone doesn't wake up a thread blocked reading the
+            # socket, shutting it down does
+            conn = getattr(response.raw, '_connection', None)
+            sock = getattr(conn, 'sock', None)
+            if sock is None:
+                # http.client drops the connection's socket when the server
+                # closes after the response, the body's reader still has it
+                try:
+                    sock = response.raw._fp.fp.raw._sock
+                except AttributeError:
+                    sock = None
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass
+            response.close()
+
+        remaining = limits['max_seconds'] - (time.time() - started)
+        deadline = threading.Timer(max(remaining, 0), expire)
+        deadline.daemon = True
+        deadline.start()
+
+        chunks = []
+        size = 0
+        with timer.stage('download'):
+            try:
+                response.raise_for_status()
+                length = response.headers.get('content-length')
+                if length and length.isdigit() and \
+                        int(length) > limits['max_bytes']:
+                    raise FetchLimitError(
+                        "Feed is {} bytes, limit is {}".format(
+                            length, limits['max_bytes']))
+                for chunk in response.iter_content(FETCH_CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > limits['max_bytes']:
+                        raise FetchLimitError("Feed exceeds {} bytes".format(
+                            limits['max_bytes']))
+                    chunks.append(chunk)
+                if expired.is_set():
+                    raise FetchLimitError("Fetch exceeds {}s".format(
+                        limits['max_seconds']))
+            except FetchLimitError:
+                raise
+            except Exception as e:
+                # reading from the closed response fails in various ways
+                if expired.is_set():
+                    raise FetchLimitError("Fetch exceeds {}s".format(
+                        limits['max_seconds']))
+                # requests reports read timeouts while streaming this way
+                if isinstance(e, requests.exceptions.ConnectionError) and \
+                        e.args and isinstance(e.args[0], ReadTimeoutError):
+                    raise FetchLimitError("Fetch timed out: {}".format(e))
+                raise
+            finally:
+                deadline.cancel()
+                response.close()
+
+        # pass the headers on, feedparser uses them for encoding detection
+        # and resolving relative links
+        headers = dict(
+            (key.lower(), value) for key, value in response.headers.items()
+        )
+        headers.setdefault('content-location', response.url)
+        with timer.stage('parse'):
+            news = feedparser.parse(b"".join(chunks), response_headers=headers)
+        news['status'] = response.status_code
+        news['href'] = response.url
+        return news
+
+    def check_feed(self, news):
+        """
+        Raises if feedparser couldn't fetch or parse a feed. feedparser
+        itself never raises, it flags broken feeds as bozo instead.
+        """
+        status = news.get('status')
+        if status is not None and status >= 400:
+            raise IOError("HTTP status {}".format(status))
+        if news.bozo and not news.entries:
+            raise news.bozo_exception
+
+    def poll_delay(self, feed_info, failures):
+        """
+        Returns the seconds to wait before polling a feed again. Failing
+        feeds back off exponentially, quarantined ones are only probed.
+        """
+        delay = int(feed_info['published'])*60
+        if not failures:
+            # pushed feeds only need a safety net poll, but must wake up in
+            # time to renew the subscription, which happens on polls
+            if self.__websub is not None and \
+                    self.__websub.is_subscribed(feed_info['id']):
+                delay = max(delay, getattr(
+                    self.__config, "WEBSUB_POLL_MINUTES", 360
+                )*60)
+                renew_in = self.__websub.renewal_due_in(feed_info['id'])
+                if renew_in is not None:
+                    delay = min(delay, max(renew_in, 60))
+            return delay
+        if is_quarantined(failures, self.__config):
+            return getattr(
+                self.__config, "FEED_PROBE_MINUTES", DEFAULT_PROBE_MINUTES
+            )*60
+        max_delay = getattr(
+            self.__config, "FEED_MAX_BACKOFF_MINUTES",
+            DEFAULT_MAX_BACKOFF_MINUTES
+        )*60
+        return min(delay * 2 ** (failures - 1), max(delay, max_delay))
+
+    def __record_failure(self, feed_info, e):
+        """
+        Stores a failed fetch and logs it. Only the first failure in a row
+        gets a traceback. Returns the consecutive failures.
+        """
+        limit_hit = isinstance(e, FetchLimitError)
+        try:
+            failures = self.__db.record_feed_failure(
+                feed_info['id'], str(e), limit_hit
+            )
+        except Exception:
+            failures = 1
+        if limit_hit:
+            print("Fetch limit hit on url: {} error {}".format(
+                feed_info['url'], e))
+        elif failures <= 1:
+            tb = traceback.format_exc()
+            print(e, tb)
+            print("Error on url: {} error {} \n {}".format(
+                feed_info['url'], e, tb))
+        elif is_quarantined(failures, self.__config) and \
+                not is_quarantined(failures - 1, self.__config):
+            print("Quarantined url: {} after {} failures, error {}".format(
+                feed_info['url'], failures, e))
+        else:
+            print("Error on url: {} error {} ({} failures in a row)".format(
+                feed_info['url'], e, failures))
+        return failures
 
     def extract_date(self, newsitem):
         """
@@ -118,9 +407,10 @@ class FeedUpdater(object):
             except Exception as e:
                 print('Error loading tinyurl', e)
                 newsurl = None
-            # if we couldn't shorten, and needed to, do this one later
-            if not newsurl and not do_shorten:
-                return
+            # if we couldn't shorten, post the long url instead, send_msg
+            # splits it over more lines if necessary
+            if not newsurl:
+                return newsitem.link
             # the tinyurl library has http links hardcoded
             newsurl = newsurl.replace(
                 'http://tinyurl.com', 'https://tinyurl.com'
@@ -128,54 +418,143 @@ class FeedUpdater(object):
 
         return newsurl
 
-    def __fetch_feed(self, feed_info, callback, forever):
+    def __feed_lock(self, feed_id):
         """
-        Fetches a RSS feed, parses it and updates the database and/or announces
-        new news.
+        Returns the lock serializing news processing for a feed, so pushed
+        and polled content don't race on the same news.
+        """
+        with self.__feed_locks_lock:
+            return self.__feed_locks.setdefault(feed_id, threading.Lock())
+
+    def __subscribe_websub(self, feed_info, news, callback):
+        """
+        Subscribes to the WebSub hub a parsed feed advertises, if any.
+        """
+        hub, topic = find_hub(news, feed_info['url'])
+        if not hub:
+            return
+        self.__push_targets[feed_info['id']] = (feed_info, callback)
+        try:
+            self.__websub.subscribe(feed_info['id'], hub, topic)
+        except Exception as e:
+            print("WebSub subscription error on url: {} error {}".format(
+                feed_info['url'], e))
+
+    def __on_push(self, feed_id, body, headers):
+        """
+        Handles feed content pushed by a WebSub hub like a polled feed.
+        """
+        if feed_id not in self.__push_targets:
+            return
+        feed_info, callback = self.__push_targets[feed_id]
+        headers.setdefault('content-location', feed_info['url'])
+        news = feedparser.parse(body, response_headers=headers)
+        print("WebSub content for url:", feed_info['url'],
+              len(news.entries), "entries")
+        with self.__deferred_lock:
+            if feed_id in self.__deferred_pushes:
+                # older pushes are still waiting, keep the order
+                self.__deferred_pushes[feed_id].append(news)
+                return
+        if self.__announce_news(feed_info, news, callback):
+            return
+        # the channel is busy, keep the push instead of waiting for the
+        # safety net poll
+        with self.__deferred_lock:
+            retry = feed_id not in self.__deferred_pushes
+            self.__deferred_pushes.setdefault(feed_id, []).insert(0, news)
+        if retry:
+            self.__schedule_push_retry(feed_id)
+
+    def __schedule_push_retry(self, feed_id):
+        retry_s = getattr(self.__config, "WEBSUB_RETRY_SECONDS", 60)
+        timer = threading.Timer(retry_s, self.__retry_pushes, (feed_id,))
+        timer.daemon = True
+        timer.start()
+
+    def __retry_pushes(self, feed_id):
+        """
+        Announces deferred pushed content in order, until the channel is
+        busy again.
         """
+        feed_info, callback = self.__push_targets[feed_id]
         while True:
+            with self.__deferred_lock:
+                pending = self.__deferred_pushes[feed_id]
+                if not pending:
+                    del self.__deferred_pushes[feed_id]
+                    return
+                news = pending[0]
             try:
-                # Parse a feed's url, do this before the idle check
-                # because this can take a significant amount of time.
-                # we want to eliminate race conditions as much as possible
-                news = feedparser.parse( feed_info['url'] )
+                announced = self.__announce_news(feed_info, news, callback)
+            except Exception as e:
+                tb = traceback.format_exc()
+                print("WebSub content error", e, "\n", tb)
+                announced = True
+            if not announced:
+                return self.__schedule_push_retry(feed_id)
+            with self.__deferred_lock:
+                pending.pop(0)
 
-                # if we have no channel observations since startup, we need
-                # to wait for one
-                observations = self.__db.chan_messages_count(
-                    self.__config.CHANNEL
-                )
+    def __chan_ready(self):
+        """
+        Returns True if the channel is idle and, with WAIT_FOR_FIRST_MSG,
+        has seen a message since startup, so news may be posted.
+        """
+        # if we have no channel observations since startup, we need
+        # to wait for one
+        observations = self.__db.chan_messages_count(
+            self.__config.CHANNEL
+        )
 
-                # check to see  if we should check feed or not
-                idle = self.__db.is_chan_idle(
-                    self.__config.CHANNEL,
-                    self.__config.IDLE_MINUTES
-                )
+        # check to see  if we should check feed or not
+        idle = self.__db.is_chan_idle(
+            self.__config.CHANNEL,
+            self.__config.IDLE_MINUTES
+        )
+
+        wait_for_observations = self.__config.WAIT_FOR_FIRST_MSG \
+            and not observations
+        return not wait_for_observations and idle
 
-                wait_for_observations = self.__config.WAIT_FOR_FIRST_MSG \
-                    and not observations
+    def __announce_news(self, feed_info, news, callback, timer=None,
+                        seen_only=False):
+        """
+        Stores the entries of a parsed feed and announces the new ones.
+        Used for both polled and pushed feed content. With 'seen_only' the
+        channel checks are skipped and all entries get stored. Returns
+        False if the entries were skipped because of channel activity.
+        """
+        timer = timer or StageTimer()
+        with self.__feed_lock(feed_info['id']):
+            if not seen_only:
+                with timer.stage('db'):
+                    ready = self.__chan_ready()
 
-                if not wait_for_observations and idle:
-                    # Reverse the ordering. Oldest first.
-                    for newsitem in news.entries[::-1]:
-                        # formatting
-                        newstitle = newsitem.title
+            if seen_only or ready:
+                # Reverse the ordering. Oldest first.
+                for newsitem in news.entries[::-1]:
+                    # formatting
+                    newstitle = newsitem.title
+                    with timer.stage('dates'):
                         newsdate = self.extract_date(newsitem)
-                        feedname = feed_info['title']
-                        fs = False
-                        if hasattr(self.__config, "FORCE_SHORTEN"):
-                            # FORCE_SHORTEN can be regex or full matched string
-                            regex_type = type(re.compile(''))
-                            for pattern in self.__config.FORCE_SHORTEN:
-                                is_re = regex_type == type(pattern)
-                                if is_re and pattern.match(feedname):
-                                    fs = True
-                                    break
-                                elif feedname == pattern:
-                                    fs = True
-                                    break
+                    feedname = feed_info['title']
+                    fs = False
+                    if hasattr(self.__config, "FORCE_SHORTEN"):
+                        # FORCE_SHORTEN can be regex or full matched string
+                        regex_type = type(re.compile(''))
+                        for pattern in self.__config.FORCE_SHORTEN:
+                            is_re = regex_type == type(pattern)
+                            if is_re and pattern.match(feedname):
+                                fs = True
+                                break
+                            elif feedname == pattern:
+                                fs = True
+                                break
+                    with timer.stage('shorten'):
                         newsurl = self.extract_url(newsitem, force_shorten=fs)
-                        # Update the database. If it's new, post it
+                    # Update the database. If it's new, post it
+                    with timer.stage('db'):
                         is_new = self.__db.insert_news(
                             feed_info['id'],
                             newstitle,
@@ -183,28 +562,79 @@ class FeedUpdater(object):
                             newsdate,
                             local_dedupe_only=feedname in self.__config.local_dedupes
                         )
-                        if is_new and callback is not None and newsurl:
+                    if is_new and callback is not None and newsurl:
+                        with timer.stage('announce'):
                             callback(
                                 feed_info['title'],
                                 newstitle,
                                 newsurl,
                                 newsdate
                             )
-                else:
-                    print(feed_info['url'], "chan", \
-                        self.__config.CHANNEL, "is idle")
+            else:
+                print(feed_info['url'], "chan", \
+                    self.__config.CHANNEL, "is idle")
+                return False
+        return True
 
+    def __fetch_feed(self, feed_info, callback, forever, seen_only=False):
+        """
+        Fetches a RSS feed, parses it and updates the database and/or announces
+        new news. 'seen_only' applies to the first successful fetch only.
+        """
+        while True:
+            failures = 0
+            timer = StageTimer()
+            news = None
+            try:
+                # Parse a feed's url, do this before the idle check
+                # because this can take a significant amount of time.
+                # we want to eliminate race conditions as much as possible
+                news = self.fetch_feed(feed_info, timer)
+                self.check_feed(news)
             except Exception as e:
-                tb = traceback.format_exc()
-                print(e, tb)
-                print("Error on url: {} error {} \n {}".format(
-                    feed_info['url'], e, tb))
+                news = None
+                failures = self.__record_failure(feed_info, e)
+
+            # the feed itself is fine, errors from here on are ours and
+            # don't count against its health
+            if news is not None:
+                try:
+                    with timer.stage('db'):
+                        self.__db.record_feed_success(feed_info['id'])
+
+                    # a polling loop's seen-only pass just catches up on
+                    # the backlog, there's nobody to print it to
+                    self.__announce_news(
+                        feed_info, news,
+                        None if seen_only and forever else callback,
+                        timer, seen_only
+                    )
+                    seen_only = False
+
+                    # let the hub push this feed to us from now on
+                    if forever and self.__websub is not None:
+                        self.__subscribe_websub(feed_info, news, callback)
+
+                except Exception as e:
+                    tb = traceback.format_exc()
+                    print("Error processing url: {} error {} \n {}".format(
+                        feed_info['url'], e, tb))
+
+            slow_s = getattr(self.__config, "SLOW_FEED_SECONDS", None)
+            if slow_s and timer.total() > slow_s:
+                print("Slow poll of url: {} {}".format(
+                    feed_info['url'], timer.summary()))
 
             if not forever:
                 break
 
-            # sleep frequency minutes
-            time.sleep(int(feed_info['published'])*60)
+            # sleep frequency minutes, longer if the feed keeps failing
+            time.sleep(self.poll_delay(feed_info, failures))
+
+            # stop polling feeds whose lease went to another worker
+            if self.__owned is not None and \
+                    feed_info['id'] not in self.__owned:
+                break
 
 if __name__ == "__main__":
     def print_line(feed_title, news_title, news_url, news_date):
@@ -212,15 +642,27 @@ if __name__ == "__main__":
             feed_title.decode("utf-8"), news_title, news_url, news_date
         )))
 
+    # python feedupdater.py --shard [worker-id]
+    sharded = len(sys.argv) > 1 and sys.argv[1] == "--shard"
+
     def main():
         config = Config()
         db = FeedDB(config)
         updater = FeedUpdater(config, db)
-        updater.update_feeds(print_line, False)
+        install_profiler(config)
+        if sharded:
+            worker_id = sys.argv[2] if len(sys.argv) > 2 else None
+            updater.run_shard(worker_id)
+        else:
+            updater.update_feeds(print_line, False, seen_only=True)
 
-    def signal_handler(signal, frame):
-        print("Caught SIGINT, terminating.")
+    def signal_handler(signum, frame):
+        print("Caught signal {}, terminating.".format(signum))
+        if sharded:
+            # unwind run_shard so it releases its leases
+            raise SystemExit(0)
         os._exit(0)
 
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
     main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers for fitting text into IRC lines. IRC limits a line to 512 bytes
+including the trailing CRLF and the prefix the server adds when relaying
+it, so all lengths here are UTF-8 encoded bytes, not characters.
+"""
+from __future__ import unicode_literals
+
+# 512 bytes minus the trailing \r\n
+MAX_LINE_BYTES = 510
+# longest hostname the server may put into our prefix when relaying
+MAX_HOST_BYTES = 63
+
+
+def to_text(msg):
+    """Returns msg as unicode text, decoding UTF-8 bytes if necessary"""
+    if isinstance(msg, bytes):
+        return msg.decode('utf-8', 'replace')
+    return msg
+
+
+def byte_len(text):
+    return len(text.encode('utf-8'))
+
+
+def max_privmsg_bytes(nick, target):
+    """
+    Returns how many bytes of text fit into a PRIVMSG to 'target' once the
+    server has prefixed it with ':nick!~user@host '.
+    """
+    prefix = ":{0}!~{0}@ PRIVMSG {1} :".format(nick, target)
+    return MAX_LINE_BYTES - byte_len(prefix) - MAX_HOST_BYTES
+
+
+def split_line(line, max_bytes):
+    """
+    Splits a single line into chunks of at most max_bytes encoded bytes,
+    breaking at whitespace where possible and never inside a character.
+    """
+    chunks = []
+    line = line.strip()
+    while byte_len(line) > max_bytes:
+        # longest prefix of whole characters that fits
+        cut = len(line.encode('utf-8')[:max_bytes].decode('utf-8', 'ignore'))
+        space = line.rfind(' ', 0, cut + 1)
+        if space > 0:
+            cut = space
+        chunks.append(line[:cut].rstrip())
+        line = line[cut:].lstrip()
+    if line:
+        chunks.append(line)
+    return chunks
+
+
+def split_message(msg, max_bytes):
+    """
+    Splits a (multi-line) message into IRC lines of at most max_bytes
+    encoded bytes each. Empty lines are dropped, nothing else is.
+    """
+    lines = []
+    for line in to_text(msg).splitlines():
+        lines.extend(split_line(line, max_bytes))
+    return lines
+
+
+def pack_messages(msgs, max_bytes, separator=" || "):
+    """
+    Joins short messages into as few lines of at most max_bytes encoded
+    bytes as possible, keeping their order. Messages too long to share a
+    line are split on their own.
+    """
+    lines = []
+    current = ""
+    for msg in msgs:
+        for part in split_message(msg, max_bytes):
+            if not current:
+                current = part
+            elif byte_len(current + separator + part) <= max_bytes:
+                current += separator + part
+            else:
+                lines.append(current)
+                current = part
+    if current:
+        lines.append(current)
+    return lines
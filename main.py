@@ -3,6 +3,7 @@
 from __future__ import print_function
 from bot import Bot
 from feedupdater import FeedUpdater
+from profiler import install as install_profiler
 import os
 import signal
 
@@ -20,8 +21,10 @@ if __name__ == "__main__":
         os._exit(1)
 
     bot._Bot__irc.connection.buffer_class.errors = 'replace' # prevent utf-8 error in jaraco.stream
-    bot.initial_feed_update()
     bot.start()
+    bot.initial_feed_update()
     signal.signal(signal.SIGINT, signal_handler)
+    # PROFILE in the config or SIGUSR1 turns the sampling profiler on/off
+    install_profiler(bot.get_config())
     while True:
         signal.pause()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Low overhead profiling: a sampling profiler writing collapsed stacks for
+flamegraph.pl / speedscope, and per-stage timings for slow feed polls.
+"""
+from __future__ import print_function
+import collections
+import contextlib
+import datetime
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+
+class SamplingProfiler(object):
+    def __init__(self, config):
+        self.__interval = getattr(config, "PROFILE_INTERVAL_MS", 50) / 1000.0
+        self.__dump_seconds = getattr(config, "PROFILE_DUMP_SECONDS", 60)
+        self.__dir = getattr(config, "PROFILE_DIR", "./profiles")
+        self.__samples = collections.Counter()
+        self.__running = threading.Event()
+        self.__thread = None
+
+    def is_running(self):
+        return self.__running.is_set()
+
+    def start(self):
+        if self.is_running():
+            return
+        self.__running.set()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        print("Profiler started, writing to", self.__dir)
+
+    def stop(self):
+        """Stops sampling and writes what was collected so far"""
+        if not self.is_running():
+            return
+        self.__running.clear()
+        self.__thread.join()
+        self.__thread = None
+        print("Profiler stopped")
+
+    def toggle(self):
+        if self.is_running():
+            self.stop()
+        else:
+            self.start()
+
+    def __sample(self):
+        """Counts the current stack of every thread but our own"""
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            # code objects are cheap to collect and hash, they only get
+            # formatted when dumping
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            name = names.get(ident) or "thread-{}".format(ident)
+            self.__samples[(name, tuple(codes))] += 1
+
+    @staticmethod
+    def __format_stack(name, codes):
+        """Returns 'thread;file:func;...' with the outermost frame first"""
+        frames = [name]
+        frames.extend(
+            "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+            for code in reversed(codes)
+        )
+        return ";".join(frames)
+
+    def dump(self):
+        """
+        Writes the samples collected since the last dump as collapsed
+        stacks ("frame;frame;frame count" per line) and resets them.
+        """
+        samples = self.__samples
+        self.__samples = collections.Counter()
+        if not samples:
+            return None
+        if not os.path.isdir(self.__dir):
+            os.makedirs(self.__dir)
+        path = os.path.join(self.__dir, "profile-{}.collapsed".format(
+            datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        ))
+        # different code objects can format alike, merge those
+        stacks = collections.Counter()
+        for (name, codes), count in samples.items():
+            stacks[self.__format_stack(name, codes)] += count
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        return path
+
+    def __run(self):
+        next_dump = time.time() + self.__dump_seconds
+        while self.is_running():
+            try:
+                self.__sample()
+                if time.time() >= next_dump:
+                    self.dump()
+                    next_dump = time.time() + self.__dump_seconds
+            except Exception as e:
+                tb = traceback.format_exc()
+                print("profiler error", e, "\n", tb)
+            time.sleep(self.__interval)
+        self.dump()
+
+
+def install(config):
+    """
+    Creates the process' profiler, starts it if PROFILE is set in the config
+    and lets SIGUSR1 toggle it. Call from the main thread.
+    """
+    profiler = SamplingProfiler(config)
+    if getattr(config, "PROFILE", False):
+        profiler.start()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle())
+    return profiler
+
+
+class StageTimer(object):
+    """
+    Adds up the time spent in named stages of a feed poll.
+    """
+    def __init__(self):
+        self.__started = time.time()
+        self.__stages = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.__stages[name] = self.__stages.get(name, 0) + \
+                time.time() - started
+
+    def total(self):
+        return time.time() - self.__started
+
+    def summary(self):
+        """Returns e.g. 'total 3.20s: fetch 2.91s, parse 0.20s, ...'"""
+        stages = ", ".join(
+            "{} {:.2f}s".format(name, seconds)
+            for name, seconds in self.__stages.items()
+        )
+        return "total {:.2f}s: {}".format(self.total(), stages)
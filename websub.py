@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+WebSub (PubSubHubbub) subscriber. Subscribes to the hubs feeds advertise
+and receives their new content on a local HTTP callback server, so those
+feeds don't need frequent polling.
+"""
+from __future__ import print_function
+import binascii
+import hashlib
+import hmac
+import os
+import threading
+import time
+import traceback
+import requests
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+# requested subscription length, hubs may grant less
+DEFAULT_LEASE_SECONDS = 10 * 24 * 60 * 60
+# give up on a hub that didn't verify a subscription within this time
+PENDING_SECONDS = 60 * 60
+# largest pushed body we accept
+MAX_BODY_BYTES = 5 * 1024 * 1024
+
+
+def find_hub(news, feed_url):
+    """
+    Returns (hub, topic) advertised by a parsed feed or (None, None). The
+    topic is the feed's rel=self link, falling back to the url we fetched.
+    """
+    hub = None
+    topic = feed_url
+    for link in news.get('feed', {}).get('links', []):
+        if link.get('rel') == 'hub' and not hub:
+            hub = link.get('href')
+        elif link.get('rel') == 'self' and link.get('href'):
+            topic = link['href']
+    if not hub:
+        return None, None
+    return hub, topic
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WebSubSubscriber(object):
+    def __init__(self, config, on_content):
+        """
+        on_content(feed_id, body, headers) gets called with every verified
+        content distribution for a subscribed feed.
+        """
+        self.__config = config
+        self.__on_content = on_content
+        self.__callback_url = config.WEBSUB_CALLBACK_URL.rstrip('/')
+        self.__lease_seconds = getattr(
+            config, "WEBSUB_LEASE_SECONDS", DEFAULT_LEASE_SECONDS
+        )
+        self.__secret = getattr(config, "WEBSUB_SECRET", None) or \
+            binascii.hexlify(os.urandom(16)).decode('ascii')
+        # feed id -> {'hub', 'topic', 'state', 'since', 'expires'}
+        self.__subscriptions = {}
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    def start(self):
+        """Starts the callback HTTP server in a background thread"""
+        if self.__server is not None:
+            return
+        subscriber = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                subscriber._handle_verification(self)
+
+            def do_POST(self):
+                subscriber._handle_content(self)
+
+        host, port = getattr(self.__config, "WEBSUB_LISTEN", ("", 8080))
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        t = threading.Thread(target=self.__server.serve_forever)
+        t.daemon = True
+        t.start()
+        print("WebSub callback server listening on port",
+              self.__server.server_address[1])
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    @property
+    def server_port(self):
+        return self.__server.server_address[1]
+
+    def callback_url(self, feed_id):
+        return "{}/websub/{}".format(self.__callback_url, feed_id)
+
+    def is_subscribed(self, feed_id):
+        """Returns True if a hub verified a still running subscription"""
+        with self.__lock:
+            sub = self.__subscriptions.get(feed_id)
+            return bool(sub) and sub['state'] == 'verified' and \
+                sub['expires'] > time.time()
+
+    def renewal_due_in(self, feed_id):
+        """
+        Returns the seconds until a verified subscription should be renewed,
+        once half of its lease is over, or None if there is none.
+        """
+        with self.__lock:
+            sub = self.__subscriptions.get(feed_id)
+            if not sub or sub['state'] != 'verified':
+                return None
+            return sub['expires'] - sub['lease'] / 2.0 - time.time()
+
+    def subscribe(self, feed_id, hub, topic):
+        """
+        Asks 'hub' to push 'topic' to our callback, unless we are subscribed
+        already and more than half of the lease is left.
+        """
+        if self.__server is None:
+            return
+        now = time.time()
+        with self.__lock:
+            sub = self.__subscriptions.get(feed_id)
+            if sub and sub['hub'] == hub and sub['topic'] == topic:
+                if sub['state'] == 'pending' and \
+                        now - sub['since'] < PENDING_SECONDS:
+                    return
+                if sub['state'] == 'verified' and \
+                        sub['expires'] - now > sub['lease'] / 2.0:
+                    return
+            self.__subscriptions[feed_id] = {
+                'hub': hub, 'topic': topic, 'state': 'pending',
+                'since': now, 'expires': 0, 'lease': self.__lease_seconds
+            }
+
+        response = requests.post(hub, data={
+            'hub.mode': 'subscribe',
+            'hub.topic': topic,
+            'hub.callback': self.callback_url(feed_id),
+            'hub.lease_seconds': self.__lease_seconds,
+            'hub.secret': self.__secret,
+        }, timeout=30)
+        if response.status_code not in (202, 204):
+            with self.__lock:
+                self.__subscriptions.pop(feed_id, None)
+            raise IOError("Hub {} refused subscription to {}: {}".format(
+                hub, topic, response.status_code))
+        print("Requested WebSub subscription for", topic, "at", hub)
+
+    def __feed_id(self, path):
+        """Returns the feed id of a callback path or None"""
+        parts = urlparse(path).path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'websub':
+            return None
+        try:
+            return int(parts[1])
+        except ValueError:
+            return None
+
+    def __reply(self, request, status, body=b""):
+        request.send_response(status)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _handle_verification(self, request):
+        """
+        Confirms the hub's verification of intent for subscriptions we
+        asked for by echoing the challenge.
+        """
+        feed_id = self.__feed_id(request.path)
+        params = dict(
+            (key, values[0])
+            for key, values in parse_qs(urlparse(request.path).query).items()
+        )
+        mode = params.get('hub.mode')
+        with self.__lock:
+            sub = self.__subscriptions.get(feed_id)
+            if mode == 'denied':
+                if sub and sub['topic'] == params.get('hub.topic'):
+                    print("WebSub subscription denied for", sub['topic'])
+                    self.__subscriptions.pop(feed_id, None)
+                return self.__reply(request, 200)
+            if mode != 'subscribe' or not sub or \
+                    sub['topic'] != params.get('hub.topic') or \
+                    'hub.challenge' not in params:
+                return self.__reply(request, 404)
+            try:
+                lease = int(params.get('hub.lease_seconds'))
+            except (TypeError, ValueError):
+                lease = self.__lease_seconds
+            sub['state'] = 'verified'
+            sub['lease'] = lease
+            sub['expires'] = time.time() + lease
+        print("WebSub subscription verified for", sub['topic'])
+        self.__reply(request, 200, params['hub.challenge'].encode('utf-8'))
+
+    def __valid_signature(self, body, signature):
+        """Checks the hub's 'method=hexdigest' HMAC of the body"""
+        if not signature or '=' not in signature:
+            return False
+        method, digest = signature.split('=', 1)
+        if method not in ('sha1', 'sha256', 'sha384', 'sha512'):
+            return False
+        expected = hmac.new(
+            self.__secret.encode('utf-8'), body, getattr(hashlib, method)
+        ).hexdigest()
+        return hmac.compare_digest(expected, str(digest.lower()))
+
+    def _handle_content(self, request):
+        """
+        Receives pushed feed content. Content without a valid signature is
+        acknowledged but dropped, as the spec requires.
+        """
+        feed_id = self.__feed_id(request.path)
+        if feed_id is None or not self.is_subscribed(feed_id):
+            return self.__reply(request, 410)
+        try:
+            length = int(request.headers.get('Content-Length', 0))
+        except ValueError:
+            length = 0
+        if length > MAX_BODY_BYTES:
+            return self.__reply(request, 413)
+        body = request.rfile.read(length)
+        self.__reply(request, 200)
+
+        if not self.__valid_signature(
+                body, request.headers.get('X-Hub-Signature')):
+            print("Dropping WebSub content with a bad signature for feed",
+                  feed_id)
+            return
+        headers = dict(
+            (key.lower(), value) for key, value in request.headers.items()
+        )
+        try:
+            self.__on_content(feed_id, body, headers)
+        except Exception as e:
+            tb = traceback.format_exc()
+            print("WebSub content error", e, "\n", tb)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A local WebSub hub stand-in for trying out push ingestion without outside
+services. Running it checks the whole flow against a WebSubSubscriber on
+localhost: subscription, verification of intent and signed content
+distribution.
+
+    python websub_hub.py
+"""
+from __future__ import print_function
+import binascii
+import hashlib
+import hmac
+import os
+import socket
+import threading
+import time
+import requests
+
+from websub import WebSubSubscriber, ThreadingHTTPServer
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urlparse import parse_qs
+
+
+class LocalHub(object):
+    def __init__(self, host="127.0.0.1", port=0):
+        # topic -> {callback: secret} of verified subscriptions
+        self.__subscribers = {}
+        self.__lock = threading.Lock()
+        hub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                params = dict(
+                    (key, values[0]) for key, values in
+                    parse_qs(self.rfile.read(length).decode('utf-8')).items()
+                )
+                if params.get('hub.mode') != 'subscribe' or \
+                        'hub.topic' not in params or \
+                        'hub.callback' not in params:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                self.send_response(202)
+                self.end_headers()
+                # verify intent asynchronously, like a real hub
+                t = threading.Thread(target=hub.verify, args=(params,))
+                t.daemon = True
+                t.start()
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        t = threading.Thread(target=self.__server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.__server.server_address)
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def verify(self, params):
+        """
+        Checks the subscriber's intent by having it echo a challenge.
+        """
+        challenge = binascii.hexlify(os.urandom(8)).decode('ascii')
+        response = requests.get(params['hub.callback'], params={
+            'hub.mode': 'subscribe',
+            'hub.topic': params['hub.topic'],
+            'hub.challenge': challenge,
+            'hub.lease_seconds': params.get('hub.lease_seconds', 3600),
+        }, timeout=10)
+        if response.status_code == 200 and response.text == challenge:
+            with self.__lock:
+                self.__subscribers.setdefault(params['hub.topic'], {})[
+                    params['hub.callback']] = params.get('hub.secret')
+            print("Hub: verified", params['hub.callback'])
+        else:
+            print("Hub: verification failed for", params['hub.callback'])
+
+    def subscribers(self, topic):
+        with self.__lock:
+            return dict(self.__subscribers.get(topic, {}))
+
+    def publish(self, topic, body, secret=None):
+        """
+        Pushes 'body' to every subscriber of 'topic', signed with their
+        secret or 'secret' if given. Returns the response status codes.
+        """
+        statuses = []
+        for callback, sub_secret in self.subscribers(topic).items():
+            headers = {'Content-Type': 'application/atom+xml'}
+            key = secret or sub_secret
+            if key:
+                headers['X-Hub-Signature'] = 'sha1=' + hmac.new(
+                    key.encode('utf-8'), body, hashlib.sha1
+                ).hexdigest()
+            statuses.append(requests.post(
+                callback, data=body, headers=headers, timeout=10
+            ).status_code)
+        return statuses
+
+
+def wait_for(check, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if check():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+if __name__ == "__main__":
+    class HubCheckConfig(object):
+        pass
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    config = HubCheckConfig()
+    config.WEBSUB_CALLBACK_URL = "http://127.0.0.1:{}".format(port)
+    config.WEBSUB_LISTEN = ("127.0.0.1", port)
+    received = []
+    subscriber = WebSubSubscriber(
+        config, lambda feed_id, body, headers: received.append(body)
+    )
+    subscriber.start()
+    hub = LocalHub()
+    topic = "http://example.com/feed"
+    body = b'<?xml version="1.0"?><feed xmlns="http://www.w3.org/2005/Atom">' \
+        b'<title>t</title><entry><title>pushed</title>' \
+        b'<link href="http://example.com/1"/></entry></feed>'
+
+    subscriber.subscribe(1, hub.url, topic)
+    assert wait_for(lambda: subscriber.is_subscribed(1)), \
+        "subscription was not verified"
+    assert hub.publish(topic, body) == [200]
+    assert wait_for(lambda: received == [body]), "signed push was not received"
+    assert hub.publish(topic, b"forged", secret="wrong") == [200]
+    time.sleep(0.5)
+    assert received == [body], "push with a bad signature was accepted"
+
+    hub.stop()
+    subscriber.stop()
+    print("OK: subscribe, verification of intent and signed push work")